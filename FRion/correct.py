@@ -9,11 +9,21 @@ The complex polarization (Q + iU) is divided by the predicted ionospheric
 modulation to produce corrected values that should have the effect of the 
 ionosphere removed. These can then be saved to new Stokes Q and U FITS files.
 
+The cubes are corrected in the axis order in which they are stored, with the
+correction broadcast along the frequency axis wherever it is. Moving the
+frequency axis to the front (np.moveaxis) would make every later operation
+stride through memory, or require a full transposed copy of each cube, so
+this is only done by readData() and write_corrected_cubes() when explicitly
+requested.
+
 The main functions below do not do anything specific to handle
 very large FITS files gracefully. It may not perform efficiently when file 
 sizes are comparable to the amount of available RAM. An alternative mode,
-`apply_correction_large_cube()`, has been developed to reduce the memory 
-footprint required.
+`apply_correction_large_cube()` (also available through the `chunked` option
+of `apply_correction_to_files()`), has been developed to reduce the memory 
+footprint required: it processes the cubes one frequency channel at a time.
+`apply_correction_dask()` does the same using Dask, so that the channels are
+processed in parallel, on one machine or across a Dask cluster.
 
 """
 
@@ -22,9 +32,41 @@ from astropy.io import fits as pf
 import os
 import sys
 from math import floor
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import numexpr as ne
+except ImportError:
+    #numexpr is optional: it lets the correction be evaluated in a single
+    #pass over the data. Without it, plain numpy is used.
+    ne=None
+try:
+    import numba
+except ImportError:
+    #numba is also optional: when available, the correction is computed by a
+    #compiled kernel that works on all frequency channels in parallel.
+    numba=None
+
+
+def set_num_threads(nthreads=None):
+    """Sets the number of threads used to compute the correction. The
+    correction is limited by memory bandwidth, so it benefits from using
+    all the available cores. Has no effect if neither numexpr nor numba is
+    installed.
+    
+    Args:
+        nthreads (int): number of threads to use [None: all available cores]
+    
+    """
+    if nthreads is None:
+        nthreads=os.cpu_count() or 1
+    if ne is not None:
+        ne.set_num_threads(min(nthreads,ne.MAX_THREADS))
+    if numba is not None:
+        numba.set_num_threads(min(nthreads,numba.config.NUMBA_NUM_THREADS))
 
 def apply_correction_to_files(Qfile,Ufile,predictionfile,Qoutfile,Uoutfile,
-                              overwrite=False):
+                              overwrite=False,chunked=False,inplace=False,
+                              compress=False,memmap=False,theta_threshold=None):
     """ This function combines all the individual steps needed to apply a 
     correction to a set of Q and U FITS cubes and save the results.
     The user should supply the paths to all the files as specified.
@@ -36,17 +78,42 @@ def apply_correction_to_files(Qfile,Ufile,predictionfile,Qoutfile,Uoutfile,
         Qoutfile (str): filename for corrected Stokes Q FITS cube.
         Uoutfile (str): filename for corrected Stokes U FITS cube.
         overwrite (bool): overwrite Stokes Q/U files if they already exist? [False]
+        chunked (bool): process the cubes one channel at a time, using
+            apply_correction_large_cube(), to reduce memory use? [False]
+        inplace (bool): overwrite the input data in memory with the corrected
+            data, rather than allocating new arrays? This halves the memory
+            needed. [False]
+        compress (bool): write tile-compressed output files? (see
+            write_corrected_cubes; not available with chunked) [False]
+        memmap (bool): memory-map the input files, rather than reading them
+            in full? All of the data are used, so reading them in one go is
+            usually faster (see readData). Not used with chunked. [False]
+        theta_threshold (float): channels where the modulation amplitude
+            |theta| is below this are set to NaN instead of being corrected
+            (see correct_cubes). [None: correct all channels]
     
     """
+    if chunked:
+        if compress:
+            raise Exception("Compressed output is not supported in chunked (large-file) mode.")
+        apply_correction_large_cube(Qfile,Ufile,predictionfile,Qoutfile,Uoutfile,
+                                    overwrite=overwrite,theta_threshold=theta_threshold)
+        return
     
     #Get all data:
-    frequencies,theta=read_prediction(predictionfile)
-    Qdata,Udata,header=readData(Qfile,Ufile)
+    frequencies,theta_real,theta_imag=read_prediction(predictionfile,split=True)
+    theta=(theta_real,theta_imag)
+    Qdata,Udata,header=readData(Qfile,Ufile,freq_first=False,memmap=memmap)
+    
+    #The data is kept in its stored axis order, so find the frequency axis
+    #(in numpy ordering). If it can't be identified, assume it is first.
+    freq_axis=find_freq_axis(header)
+    axis=header['NAXIS']-freq_axis if freq_axis != 0 else 0
     
     #Checks for data consistency.
     if (Qdata.shape != Udata.shape):
         raise Exception("Q and U files don't have same dimensions.")
-    if Qdata.shape[0] != theta.size:
+    if Qdata.shape[axis] != theta_real.size:
         raise Exception("Prediction file does not have same number of channels as FITS cube.")
     #Currently this doesn't actually check that the frequencies are the same,
     #just that the number of channels is the same. Should this be a more
@@ -54,27 +121,47 @@ def apply_correction_to_files(Qfile,Ufile,predictionfile,Qoutfile,Uoutfile,
 
 
     #Apply correction
-    Qcorr,Ucorr=correct_cubes(Qdata,Udata,theta)
+    if inplace:
+        Qcorr,Ucorr=correct_cubes(Qdata,Udata,theta,out_Q=Qdata,out_U=Udata,
+                                  axis=axis,theta_threshold=theta_threshold)
+    else:
+        Qcorr,Ucorr=correct_cubes(Qdata,Udata,theta,axis=axis,
+                                  theta_threshold=theta_threshold)
     
     #Save results
     write_corrected_cubes(Qoutfile,Uoutfile,Qcorr,Ucorr,header,
-                          overwrite=overwrite)
+                          overwrite=overwrite,freq_first=False,compress=compress,
+                          freq_axis=freq_axis)
 
 
 
-def read_prediction(filename):
+def read_prediction(filename,split=False):
     """Read in frequencies and ionospheric predictions from text file.
     
+    Args:
+        filename (str): path to ionospheric modulation prediction
+        split (bool): return the real and imaginary parts of the modulation
+            as separate real arrays, rather than as one complex array? The
+            correction only needs the real and imaginary parts, so this
+            avoids packing and then unpacking a complex array. [False]
+    
     Returns:
         tuple containing
         
         -frequencies (array): frequencies of each channel (Hz); 
 
         -theta (array): ionospheric modulation for each channel
+        (if split, this is replaced by two arrays: theta_real, theta_imag)
         
     """
-    (frequencies,real,imag)=np.genfromtxt(filename,unpack=True)
-    theta=real+1.j*imag
+    #The prediction files are plain columns of numbers, so the simpler (and
+    #much faster) loadtxt can be used rather than genfromtxt.
+    (frequencies,real,imag)=np.loadtxt(filename,unpack=True,ndmin=2)
+    if split:
+        return frequencies, real, imag
+    theta=np.empty(real.size,dtype=np.complex128)
+    theta.real=real
+    theta.imag=imag
     return frequencies, theta
 
 
@@ -85,55 +172,85 @@ def find_freq_axis(header):
     Returns 0 if the frequency axis cannot be found.
     
     """
-    freq_axis=0 #Default for 'frequency axis not identified'
     #Check for frequency axes. Because I don't know what different formatting
     #I might get ('FREQ' vs 'OBSFREQ' vs 'Freq' vs 'Frequency'), convert to
-    #all caps and check for 'FREQ' anywhere in the axis name.
-    for i in range(1,header['NAXIS']+1):  #Check each axis in turn.
-        try:
-            if 'FREQ' in header['CTYPE'+str(i)].upper():
-                freq_axis=i
-        except:
-            pass #The try statement is needed for if the FITS header does not
-                 # have CTYPE keywords.
-    return freq_axis
-
-
-def readData(Qfilename,Ufilename):
+    #all caps and check for 'FREQ' anywhere in the axis name. Axes without
+    #CTYPE keywords are treated as not being frequency.
+    freq_axes=[i for i in range(1,header['NAXIS']+1)
+               if 'FREQ' in str(header.get('CTYPE'+str(i),'')).upper()]
+    return freq_axes[-1] if freq_axes else 0 #0 for 'frequency axis not identified'
+
+
+def readData(Qfilename,Ufilename,freq_first=True,memmap=True):
     """Open the Stokes Q and U input cubes (from the supplied 
     file names) and return data-access variables and the header. 
-    Axes are re-ordered so that frequency is first, beyond that the number
-    and ordering of axes doesn't matter.
-    Uses the memmap functionality so that data isn't read into data; variables
-    are just handles to access the data on disk.
+    By default, axes are re-ordered so that frequency is first, beyond that
+    the number and ordering of axes doesn't matter. The re-ordered arrays are
+    not contiguous in memory, which makes any subsequent operations slow; set
+    freq_first=False to keep the stored axis order instead.
+    By default, uses the memmap functionality so that data isn't read into
+    memory; variables are just handles to access the data on disk. This is
+    best when only part of the data will be used. When all of the data will
+    be processed, memory-mapping only defers the cost of reading it (as page
+    faults, one page at a time, while holding the files open), so it is
+    faster to set memmap=False and read each file in one go. In that case the
+    data are also converted to native byte order, in place.
     Returns the header from the Q file, the U file's header is ignored.
+    The two files are opened concurrently.
     
     """    
     
-    hdulistQ=pf.open(Qfilename,memmap=True)
-    header=hdulistQ[0].header
-    Qdata=hdulistQ[0].data
-    hdulistU=pf.open(Ufilename,memmap=True)
-    Udata=hdulistU[0].data
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        (header,Qdata),(_,Udata)=executor.map(_read_cube,(Qfilename,Ufilename),
+                                              (memmap,memmap))
     
     
-    N_dim=header['NAXIS'] #Get number of axes
-
-    freq_axis=find_freq_axis(header) 
-    #If the frequency axis isn't the last one, rotate the array until it is.
-    #Recall that pyfits reverses the axis ordering, so we want frequency on
-    #axis 0 of the numpy array.
-    if freq_axis != 0 and freq_axis != N_dim:
-        Qdata=np.moveaxis(Qdata,N_dim-freq_axis,0)
-        Udata=np.moveaxis(Udata,N_dim-freq_axis,0)
+    if freq_first:
+        N_dim=header['NAXIS'] #Get number of axes
+        freq_axis=find_freq_axis(header) 
+        #If the frequency axis isn't the last one, rotate the array until it is.
+        #Recall that pyfits reverses the axis ordering, so we want frequency on
+        #axis 0 of the numpy array.
+        if freq_axis != 0 and freq_axis != N_dim:
+            Qdata=np.moveaxis(Qdata,N_dim-freq_axis,0)
+            Udata=np.moveaxis(Udata,N_dim-freq_axis,0)
 
     
     return Qdata, Udata, header
 
 
-def write_corrected_cubes(Qoutputname,Uoutputname,Qcorr,Ucorr,header,overwrite=False):
+def _read_cube(filename,memmap=True):
+    """Opens a FITS file, returning the header and data of the primary HDU.
+    Without memmap, the data are read in full, the file is closed, and the
+    data are byte-swapped to native order (which the numba kernels need).
+    """
+    if memmap:
+        hdulist=pf.open(filename,memmap=True)
+        return hdulist[0].header, hdulist[0].data
+    with pf.open(filename,memmap=False) as hdulist:
+        header=hdulist[0].header
+        data=hdulist[0].data
+    if not data.dtype.isnative:
+        data=data.byteswap(inplace=True).view(data.dtype.newbyteorder('='))
+    return header, data
+
+
+def write_corrected_cubes(Qoutputname,Uoutputname,Qcorr,Ucorr,header,overwrite=False,
+                          freq_first=True,compress=False,freq_axis=None):
     """    Write the corrected Q and U data to FITS files. Copies the supplied 
     header, adding a note to the history saying that the correction was applied.
+    If the data have the frequency axis first (as returned by readData by
+    default), the axes are put back into the order given by the header.
+    The Q and U files are written concurrently, as the two writes are
+    independent and limited by I/O.
+    
+    Optionally, the output can be written with FITS tile compression (RICE),
+    with one tile per frequency plane so individual channels can still be
+    read efficiently. This can make the files several times smaller and
+    faster to write, but note that floating point data is quantized
+    (quantize_level=16, i.e. to 1/16 of the noise in each tile), so the
+    compression is lossy. The data are stored in a compressed image
+    extension, after an empty primary HDU. Requires Astropy 5.3 or newer.
     
     Inputs:
         Qoutputname (str): filename to write corrected Stoke Q data to.
@@ -142,6 +259,10 @@ def write_corrected_cubes(Qoutputname,Uoutputname,Qcorr,Ucorr,header,overwrite=F
         Ucorr (array): corrected Stokes U data
         header: Astropy FITS header object that describes the data
         overwrite (bool): overwrite Stokes Q/U files if they already exist? [False]
+        freq_first (bool): is the frequency axis of the data first? [True]
+        compress (bool): write tile-compressed FITS files? [False]
+        freq_axis (int): frequency axis number, as recorded in the FITS file,
+            if already known [None: find from header]
         
     """
     output_header=header.copy()
@@ -149,45 +270,321 @@ def write_corrected_cubes(Qoutputname,Uoutputname,Qcorr,Ucorr,header,overwrite=F
 
     #Get data back to original axis order, if necessary.
     N_dim=output_header['NAXIS'] #Get number of axes
-    freq_axis=find_freq_axis(output_header)
-    if freq_axis != 0:
-        Qcorr=np.moveaxis(Qcorr,0,N_dim-freq_axis)
-        Ucorr=np.moveaxis(Ucorr,0,N_dim-freq_axis)
+    if freq_axis is None:
+        freq_axis=find_freq_axis(output_header)
+    #Moving the axes gives a strided view, which would be copied when written
+    #anyway; instead, make that one unavoidable copy explicitly, directly into
+    #a contiguous array in FITS (big-endian) byte order, so the reordering
+    #and byte-swapping are done in a single pass and astropy can write the
+    #result without copying it again.
+    if freq_first and freq_axis != 0 and freq_axis != N_dim:
+        Qcorr=_fits_ordered_copy(np.moveaxis(Qcorr,0,N_dim-freq_axis))
+        Ucorr=_fits_ordered_copy(np.moveaxis(Ucorr,0,N_dim-freq_axis))
 
 
-    pf.writeto(Qoutputname,Qcorr,output_header,overwrite=overwrite)
-    pf.writeto(Uoutputname,Ucorr,output_header,overwrite=overwrite)
+    if compress:
+        #One tile per frequency plane.
+        tile_shape=list(Qcorr.shape)
+        tile_shape[N_dim-freq_axis if freq_axis != 0 else 0]=1
+        tile_shape=tuple(tile_shape)
+    else:
+        tile_shape=None
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures=[executor.submit(_write_cube,filename,data,output_header,
+                                 overwrite,tile_shape)
+                 for filename,data in ((Qoutputname,Qcorr),(Uoutputname,Ucorr))]
+        for future in futures:
+            future.result()  #Raises any exception from the write.
+
+
+def _fits_ordered_copy(data):
+    """Returns a C-contiguous, big-endian copy of an array."""
+    output=np.empty(data.shape,dtype=data.dtype.newbyteorder('>'))
+    output[...]=data
+    return output
+
+
+def _write_cube(filename,data,header,overwrite,tile_shape=None):
+    """Writes a single cube to a FITS file; if tile_shape is given, this is
+    a RICE-compressed image extension with that tile shape.
+    """
+    if tile_shape is None:
+        pf.writeto(filename,data,header,overwrite=overwrite)
+    else:
+        hdu=pf.CompImageHDU(data,header,compression_type='RICE_1',
+                            tile_shape=tile_shape,quantize_level=16)
+        pf.HDUList([pf.PrimaryHDU(),hdu]).writeto(filename,overwrite=overwrite)
 
     
 
 
-def correct_cubes(Qdata,Udata,theta):
+def correct_cubes(Qdata,Udata,theta,out_Q=None,out_U=None,axis=0,
+                  theta_threshold=None,parallel=True):
     """Applies the ionospheric Faraday rotation correction to the Stokes Q/U
     data, derotating the polarization angle and renormalizing to remove
     depolarization. Note that this will amplify the noise present in the data,
-    particularly if the depolarization is large (\|theta\| is small).
+    particularly if the depolarization is large (|theta| is small).
+    
+    The corrected data can be written into existing arrays by supplying
+    out_Q and out_U. These may be the input arrays themselves (out_Q=Qdata,
+    out_U=Udata), in which case the correction is done in place and no
+    additional cube-sized arrays are allocated.
+    
+    The correction is computed at the precision of the input data (e.g.
+    single precision for 32-bit FITS cubes), rather than being promoted to
+    double precision. The modulation varies smoothly and is close to unit
+    magnitude, so single precision is sufficient, and it halves both the
+    memory traffic and the size of the output.
+    
+    The frequency axis can be in any position (given by axis, in numpy
+    ordering). Correcting the data in its stored axis order is much faster
+    than re-ordering the axes first, which requires a transposed copy.
+    
+    Channels where the modulation is very small (strong depolarization) can
+    only be corrected by amplifying the noise enormously, so the result is
+    usually unusable. If theta_threshold is given, channels with
+    |theta| < theta_threshold are not computed at all, and are set to NaN.
     
     Inputs:
-        Qdata (array): uncorrected Stokes Q data, frequency axis first
-        Udata (array): uncorrected Stokes U data, frequency axis first
-        theta (1D array): ionospheric modulation, per frequency
+        Qdata (array): uncorrected Stokes Q data
+        Udata (array): uncorrected Stokes U data
+        theta (1D array): ionospheric modulation, per frequency. This can
+            be complex, or a tuple of two real arrays (real part, imaginary
+            part) as returned by read_prediction(split=True).
+        out_Q (array): array to store corrected Stokes Q data in [None: new array]
+        out_U (array): array to store corrected Stokes U data in [None: new array]
+        axis (int): frequency axis of the data, in numpy ordering [0]
+        theta_threshold (float): minimum |theta| for a channel to be
+            corrected; other channels are set to NaN [None: correct all channels]
+        parallel (bool): use the multi-threaded numba kernels? Set to False
+            when calling this from several threads at once. [True]
     
     Returns:
         Qcorr (array): corrected Stokes Q data, same axis ordering
         Ucorr (array): corrected Stokes U data, same axis ordering
     """
     
-    Pdata=Qdata+1.j*Udata #Input complex polarization
-    arrshape=np.array(Pdata.shape)  #the correction needs the same number of
-    arrshape[:]=1                   #axes as the input data
-    arrshape[0]=theta.size     #(but they can all be degenerate)
-    Pcorr=np.true_divide(Pdata,np.reshape(theta,arrshape))
-    Qcorr=Pcorr.real
-    Ucorr=Pcorr.imag
+    #Dividing by theta is the same as multiplying by 1/theta, which only
+    #needs computing once per channel. Writing 1/theta = c+id, the complex
+    #multiplication is expanded into real arithmetic,
+    # (Q+iU)*(c+id) = (Q*c-U*d) + i(U*c+Q*d),
+    #so that Q and U are each read once and no complex copies of the cubes
+    #are ever created.
+    # c = Re(theta)/|theta|^2, d = -Im(theta)/|theta|^2
+    dtype=np.result_type(Qdata.dtype,Udata.dtype,np.float32)
+    if isinstance(theta,tuple):
+        theta_real,theta_imag=(np.asarray(part,dtype=np.float64) for part in theta)
+    else:
+        theta_real,theta_imag=theta.real,theta.imag
+    mod2=theta_real**2+theta_imag**2
+    if theta_threshold is None:
+        good=np.ones(mod2.size,dtype=bool)
+    else:
+        good=mod2 >= theta_threshold**2
+    #Skipped channels (e.g. theta=0) never have their reciprocal computed.
+    inv_mod2=np.divide(1.,mod2,out=np.zeros_like(mod2),where=good)
+    c=(theta_real*inv_mod2).astype(dtype)
+    d=(-theta_imag*inv_mod2).astype(dtype)
+    axis=axis % Qdata.ndim
+    #The kernels below take the channel count from theta, so a mismatch
+    #would otherwise go unnoticed (or read past the end of theta).
+    if Qdata.shape != Udata.shape:
+        raise Exception("Q and U data don't have same dimensions.")
+    if theta_real.size != Qdata.shape[axis]:
+        raise Exception("Modulation does not have same number of channels as data.")
+
+    Qcorr=np.empty(Qdata.shape,dtype=dtype) if out_Q is None else out_Q
+    Ucorr=np.empty(Udata.shape,dtype=dtype) if out_U is None else out_U
+
+    if theta_threshold is not None:
+        #Flag the bad channels first: each channel is independent of the
+        #others, so this is safe even when correcting in place.
+        index=[slice(None)]*Qdata.ndim
+        index[axis]=~good
+        Qcorr[tuple(index)]=np.nan
+        Ucorr[tuple(index)]=np.nan
+
+    aliased=any(np.may_share_memory(out,data) for out in (Qcorr,Ucorr) for data in (Qdata,Udata))
+    index=[slice(None)]*Qdata.ndim
+    #Correct each consecutive run of good channels (normally, just one run
+    #covering all channels) in a single call.
+    edges=np.flatnonzero(np.diff(np.concatenate(([0],good.view(np.int8),[0]))))
+    for start,stop in zip(edges[::2],edges[1::2]):
+        index[axis]=slice(start,stop)
+        channels=tuple(index)
+        arrays=(Qdata[channels],Udata[channels],Qcorr[channels],Ucorr[channels])
+        if not aliased or _uses_numba(arrays):
+            #The numba kernels read each Q,U pair before writing it, so they
+            #are safe in place and still use all threads on the whole cube.
+            _correct_arrays(arrays[0],arrays[1],c[start:stop],d[start:stop],
+                            arrays[2],arrays[3],axis,parallel)
+            continue
+        #numexpr and numpy compute Qcorr and Ucorr in separate passes, so
+        #writing either output would overwrite input still needed for the
+        #other. Work one channel at a time, from copies of only the current
+        #Q and U planes.
+        index[axis]=slice(0,1)
+        Qplane=np.empty(Qdata[tuple(index)].shape,dtype=Qdata.dtype)
+        Uplane=np.empty(Udata[tuple(index)].shape,dtype=Udata.dtype)
+        for k in range(start,stop):
+            index[axis]=slice(k,k+1)
+            channel=tuple(index)
+            Qplane[...]=Qdata[channel]
+            Uplane[...]=Udata[channel]
+            _correct_arrays(Qplane,Uplane,c[k:k+1],d[k:k+1],
+                            Qcorr[channel],Ucorr[channel],axis,parallel)
     
     return Qcorr,Ucorr
 
 
+def _uses_numba(arrays):
+    """Checks whether _correct_arrays() will use a numba kernel for the
+    arrays (Q, U, Qcorr, Ucorr).
+    """
+    #The compiled kernels need native byte order (FITS data is big-endian).
+    if numba is None or not all(arr.dtype.isnative for arr in arrays):
+        return False
+    return all(arr.flags.c_contiguous for arr in arrays) or arrays[0].ndim in _STRIDED_KERNELS
+
+
+def _correct_arrays(Q,U,c,d,Qcorr,Ucorr,axis,parallel=True):
+    """Evaluates the real-valued form of the correction, writing the results
+    into Qcorr and Ucorr. The frequency axis of Q, U, Qcorr and Ucorr is given
+    by axis, and c and d are 1D arrays with the real and imaginary parts of
+    1/theta for each channel. If parallel is False, the single-threaded
+    versions of the numba kernels are used.
+    Qcorr and Ucorr must not share memory with Q or U, unless _uses_numba()
+    is true for these arrays (and then only as the very same arrays).
+    """
+    arrays=(Q,U,Qcorr,Ucorr)
+    #Contiguous arrays are viewed as (outer axes, channel, inner axes)
+    #without copying; other 3D and 4D arrays (e.g. slices, or axis-reordered
+    #views) go to kernels specialized for that number of axes, which accept
+    #any strides.
+    use_numba=_uses_numba(arrays)
+    if use_numba and not all(arr.flags.c_contiguous for arr in arrays):
+        views=[np.moveaxis(arr,axis,0) for arr in arrays]
+        kernel=_STRIDED_KERNELS[Q.ndim]
+        if not parallel:
+            kernel=_SERIAL_KERNELS[kernel]
+        kernel(views[0],views[1],c,d,views[2],views[3])
+        return
+    if use_numba and all(arr.flags.c_contiguous for arr in arrays):
+        Nchan=c.size
+        Nouter=int(np.prod(Q.shape[:axis]))
+        if Q.size // (Nouter*Nchan) == 1:
+            #Frequency is the fastest-varying axis: each spectrum is contiguous.
+            kernel=_correct_kernel_freq_last
+            views=[arr.reshape(Nouter,Nchan) for arr in arrays]
+        else:
+            kernel=_correct_kernel
+            views=[arr.reshape(Nouter,Nchan,-1) for arr in arrays]
+        if not parallel:
+            kernel=_SERIAL_KERNELS[kernel]
+        kernel(views[0],views[1],c,d,views[2],views[3])
+        return
+
+    if ne is not None:
+        arrshape=np.ones(Q.ndim,dtype=int)  #the correction needs the same number of
+        arrshape[axis]=c.size               #axes as the input data (but they can all be degenerate)
+        local_dict={'Q':Q,'U':U,'c':np.reshape(c,arrshape),'d':np.reshape(d,arrshape)}
+        ne.evaluate('Q*c-U*d',local_dict=local_dict,out=Qcorr,casting='same_kind')
+        ne.evaluate('U*c+Q*d',local_dict=local_dict,out=Ucorr,casting='same_kind')
+        return
+
+    #Plain numpy: go channel by channel, with every operation writing into
+    #the output arrays, so the only temporary array is a single plane.
+    index=[slice(None)]*Q.ndim
+    index[axis]=slice(0,1)
+    scratch=np.empty(Qcorr[tuple(index)].shape,dtype=Qcorr.dtype)
+    for k in range(c.size):
+        index[axis]=slice(k,k+1)
+        channel=tuple(index)
+        Qk,Uk,Qcorr_k,Ucorr_k=Q[channel],U[channel],Qcorr[channel],Ucorr[channel]
+        np.multiply(Qk,c[k],out=Qcorr_k)
+        np.multiply(Uk,d[k],out=scratch)
+        np.subtract(Qcorr_k,scratch,out=Qcorr_k)
+        np.multiply(Uk,c[k],out=Ucorr_k)
+        np.multiply(Qk,d[k],out=scratch)
+        np.add(Ucorr_k,scratch,out=Ucorr_k)
+
+
+if numba is not None:
+    @numba.njit(parallel=True,fastmath=True,cache=True)
+    def _correct_kernel(Q,U,c,d,Qcorr,Ucorr):
+        """Compiled form of the correction for (outer, channel, pixel) arrays.
+        Each channel only needs its own two coefficients, so channels are
+        distributed across threads, and the pixels of each channel plane are
+        contiguous.
+        """
+        for k in numba.prange(Q.shape[1]):
+            ck=c[k]
+            dk=d[k]
+            for j in range(Q.shape[0]):
+                for i in range(Q.shape[2]):
+                    q=Q[j,k,i]
+                    u=U[j,k,i]
+                    Qcorr[j,k,i]=q*ck-u*dk
+                    Ucorr[j,k,i]=u*ck+q*dk
+
+    @numba.njit(parallel=True,fastmath=True,cache=True)
+    def _correct_kernel_freq_last(Q,U,c,d,Qcorr,Ucorr):
+        """Compiled form of the correction for (pixel, channel) arrays, where
+        each spectrum is contiguous. Spectra are distributed across threads.
+        """
+        for j in numba.prange(Q.shape[0]):
+            for k in range(Q.shape[1]):
+                q=Q[j,k]
+                u=U[j,k]
+                Qcorr[j,k]=q*c[k]-u*d[k]
+                Ucorr[j,k]=u*c[k]+q*d[k]
+
+    @numba.njit(parallel=True,fastmath=True,cache=True)
+    def _correct_kernel_3d(Q,U,c,d,Qcorr,Ucorr):
+        """Compiled form of the correction for 3D arrays of any strides,
+        with the frequency axis first.
+        """
+        for k in numba.prange(Q.shape[0]):
+            ck=c[k]
+            dk=d[k]
+            for j in range(Q.shape[1]):
+                for i in range(Q.shape[2]):
+                    q=Q[k,j,i]
+                    u=U[k,j,i]
+                    Qcorr[k,j,i]=q*ck-u*dk
+                    Ucorr[k,j,i]=u*ck+q*dk
+
+    @numba.njit(parallel=True,fastmath=True,cache=True)
+    def _correct_kernel_4d(Q,U,c,d,Qcorr,Ucorr):
+        """Compiled form of the correction for 4D arrays of any strides,
+        with the frequency axis first.
+        """
+        for k in numba.prange(Q.shape[0]):
+            ck=c[k]
+            dk=d[k]
+            for l in range(Q.shape[1]):
+                for j in range(Q.shape[2]):
+                    for i in range(Q.shape[3]):
+                        q=Q[k,l,j,i]
+                        u=U[k,l,j,i]
+                        Qcorr[k,l,j,i]=q*ck-u*dk
+                        Ucorr[k,l,j,i]=u*ck+q*dk
+
+    #Strided kernels, by number of axes (3 and 4 cover almost all cubes).
+    _STRIDED_KERNELS={3:_correct_kernel_3d,4:_correct_kernel_4d}
+
+    #Single-threaded versions of each kernel (prange acts as range), for
+    #callers that already run in parallel threads, such as dask workers:
+    #starting numba parallel regions from several threads at once either
+    #oversubscribes the cores or, with numba's workqueue threading layer,
+    #aborts the process. These are not cached on disk, as their cache entries
+    #would clash with those of the parallel kernels.
+    _SERIAL_KERNELS={kernel:numba.njit(fastmath=True)(kernel.py_func)
+                     for kernel in (_correct_kernel,_correct_kernel_freq_last,
+                                    _correct_kernel_3d,_correct_kernel_4d)}
+
+
 
 def progress(width, percent):
     """
@@ -204,18 +601,104 @@ def progress(width, percent):
     sys.stdout.flush()
 
 
+def read_plane(hdulist,k,freq_axis):
+    """Read a single frequency plane from the primary HDU of a FITS file.
+    This uses Astropy's section interface, which reads only the requested
+    plane from disk (applying any BSCALE/BZERO scaling to just that plane),
+    rather than memory-mapping or loading the whole cube.
+    
+    Args:
+        hdulist: Astropy HDUList of the open FITS file
+        k (int): channel number to read
+        freq_axis (int): frequency axis number, as recorded in the FITS file
+            (as returned by find_freq_axis)
+    
+    Returns:
+        array: the data for channel k, with the frequency axis removed.
+    """
+    return hdulist[0].section[_plane_index(hdulist[0].header['NAXIS'],freq_axis,k)]
+
+
+def write_plane(hdulist,k,freq_axis,data):
+    """Write a single frequency plane into the primary HDU of a FITS file
+    that has been opened in update mode (with memmap=True, so that only that
+    plane is changed in memory).
+    
+    Args:
+        hdulist: Astropy HDUList of the open FITS file
+        k (int): channel number to write
+        freq_axis (int): frequency axis number, as recorded in the FITS file
+        data (array): the data for channel k, with the frequency axis removed.
+    """
+    hdulist[0].data[_plane_index(hdulist[0].header['NAXIS'],freq_axis,k)]=data
+
+
+def _plane_index(N_dim,freq_axis,k):
+    """Numpy index selecting channel k of a FITS data array with N_dim axes
+    and the given frequency axis (in FITS numbering).
+    """
+    index=[slice(None)]*N_dim
+    index[N_dim-freq_axis]=k
+    return tuple(index)
+
+
+def _create_output_files(header,Qoutfile,Uoutfile,overwrite):
+    """Creates blank output FITS files, of the size described by the input
+    header, for the large-file modes to write the corrected data into.
+    Returns the header of the output files.
+    """
+    #Add correction to header history
+    output_header=header.copy()
+    output_header.add_history('Corrected for ionospheric Faraday rotation using FRion.')
+    #The corrected data are floating point, so integer (scaled) input
+    #formats are not carried over to the output.
+    if output_header['BITPIX'] > 0:
+        output_header['BITPIX']=-32
+    for key in ('BSCALE','BZERO','BLANK'):
+        if key in output_header:
+            del output_header[key]
+
+
+    #Deal with any existing output files:
+    if (os.path.isfile(Qoutfile) or os.path.isfile(Uoutfile)) and not overwrite:
+        raise Exception("Output file(s) aready exist.")
+    if os.path.isfile(Qoutfile) and overwrite:
+        os.remove(Qoutfile)
+    if os.path.isfile(Uoutfile) and overwrite:
+        os.remove(Uoutfile)
+        
+    #Create large blank files. This seems to produce file size complaints 
+    #sometimes, but those seem harmless so far.
+    shape = tuple(output_header['NAXIS{0}'.format(ii)] for ii in range(1, output_header['NAXIS']+1))
+    
+    output_header.tofile(Qoutfile)
+    with open(Qoutfile, 'rb+') as fobj:
+        fobj.seek(len(output_header.tostring()) + (np.prod(shape) * np.abs(output_header['BITPIX']//8)) - 1)
+        fobj.write(b'\0')
+
+    output_header.tofile(Uoutfile)
+    with open(Uoutfile, 'rb+') as fobj:
+        fobj.seek(len(output_header.tostring()) + (np.prod(shape) * np.abs(output_header['BITPIX']//8)) - 1)
+        fobj.write(b'\0')
+
+    return output_header
+
+
 def apply_correction_large_cube(Qfile,Ufile,predictionfile,Qoutfile,Uoutfile,
-                              overwrite=False):
+                              overwrite=False,theta_threshold=None):
     """Functions as apply_correction_to_files, but for files too large to
     hold in memory. Combines the correct_cubes() and write_corrected_cubes()
     steps into a single function so that it can operate on smaller pieces
-    of data at one time.
+    of data at one time. The cubes are processed one frequency channel at a
+    time, so only a single plane of each input and output cube needs to be
+    held in memory; the output files are created on disk beforehand and
+    filled in plane by plane.
     
     This function combines all the individual steps needed to apply a 
     correction to a set of Q and U FITS cubes and save the results.
     The user should supply the paths to all the files as specified.
-    This function is less flexible in terms of axis ordering: it assumes two
-    spatial axes, and a frequency axis in position 3 or 4.
+    This function requires that the frequency axis can be identified from
+    the FITS header.
     
     Args:
         Qfile (str): filename of uncorrected Stokes Q FITS cube
@@ -224,95 +707,233 @@ def apply_correction_large_cube(Qfile,Ufile,predictionfile,Qoutfile,Uoutfile,
         Qoutfile (str): filename for corrected Stokes Q FITS cube.
         Uoutfile (str): filename for corrected Stokes U FITS cube.
         overwrite (bool): overwrite Stokes Q/U files if they already exist? [False]
+        theta_threshold (float): channels where the modulation amplitude
+            |theta| is below this are set to NaN without being read or
+            corrected. [None: correct all channels]
     
     """
 
 
     #Get all data:
-    frequencies,theta=read_prediction(predictionfile)
+    frequencies,theta_real,theta_imag=read_prediction(predictionfile,split=True)
+    theta=(theta_real,theta_imag)
 
-    hdulistQ=pf.open(Qfile,memmap=True)
+    #The data are only accessed one plane at a time, through read_plane(),
+    #so the full cubes are never loaded or memory-mapped.
+    hdulistQ=pf.open(Qfile)
     header=hdulistQ[0].header
-    Qdata=hdulistQ[0].data
-    hdulistU=pf.open(Ufile,memmap=True)
-    Udata=hdulistU[0].data
+    hdulistU=pf.open(Ufile)
     
     
     N_dim=header['NAXIS'] #Get number of axes
     freq_axis=find_freq_axis(header) 
     #Checks for data consistency.
-    if (Qdata.shape != Udata.shape):
+    if freq_axis == 0:
+        raise Exception("Could not identify frequency axis; this is required for large files.")
+    if (hdulistQ[0].shape != hdulistU[0].shape):
         raise Exception("Q and U files don't have same dimensions.")
-    if Qdata.shape[N_dim-freq_axis] != theta.size:
+    if hdulistQ[0].shape[N_dim-freq_axis] != theta_real.size:
         raise Exception("Prediction file does not have same number of channels as FITS cube.")
     #Currently this doesn't actually check that the frequencies are the same,
     #just that the number of channels is the same. Should this be a more
     #strict check?
-    if Qdata.ndim != 3 and Qdata.ndim != 4:
-        raise Exception("Cube does not have 3 or 4 axes; only these are supported for large files.")
     
 
-    #Add correction to header history
-    output_header=header.copy()
-    output_header.add_history('Corrected for ionospheric Faraday rotation using FRion.')
-
-
-
-    #Deal with any existing output files:
-    if (os.path.isfile(Qoutfile) or os.path.isfile(Uoutfile)) and not overwrite:
-        raise Exception("Output file(s) aready exist.")
-    if os.path.isfile(Qoutfile) and overwrite:
-        os.remove(Qoutfile)
-    if os.path.isfile(Uoutfile) and overwrite:
-        os.remove(Uoutfile)
-        
-    #Create large blank files. This seems to produce file size complaints 
-    #sometimes, but those seem harmless so far.
-    shape = tuple(output_header['NAXIS{0}'.format(ii)] for ii in range(1, output_header['NAXIS']+1))
-    
-    output_header.tofile(Qoutfile)
-    with open(Qoutfile, 'rb+') as fobj:
-        fobj.seek(len(output_header.tostring()) + (np.product(shape) * np.abs(output_header['BITPIX']//8)) - 1)
-        fobj.write(b'\0')
-
-    output_header.tofile(Uoutfile)
-    with open(Uoutfile, 'rb+') as fobj:
-        fobj.seek(len(output_header.tostring()) + (np.product(shape) * np.abs(output_header['BITPIX']//8)) - 1)
-        fobj.write(b'\0')
-
+    output_header=_create_output_files(header,Qoutfile,Uoutfile,overwrite)
 
     Qout_hdu=pf.open(Qoutfile,mode='update',memmap=True)
     Uout_hdu=pf.open(Uoutfile,mode='update',memmap=True)
 
-    Npix=output_header['NAXIS1']*output_header['NAXIS2']
-
-    for i in range(Npix):
-        x=i % output_header['NAXIS1'] 
-        y=i // output_header['NAXIS1']
-        if N_dim==4:
-            Pdata=Qdata[:,:,y,x]+1.j*Udata[:,:,y,x] #Input complex polarization
-        elif N_dim==3:
-            Pdata=Qdata[:,y,x]+1.j*Udata[:,y,x] #Input complex polarization
-        arrshape=np.array(Pdata.shape)  #the correction needs the same number of
-        arrshape[:]=1                   #axes as the input data
-        arrshape[N_dim-freq_axis]=theta.size     #(but they can all be degenerate)
-        Pcorr=np.true_divide(Pdata,np.reshape(theta,arrshape))
-        if N_dim==4:
-            Qout_hdu[0].data[:,:,y,x]=Pcorr.real
-            Uout_hdu[0].data[:,:,y,x]=Pcorr.imag
-        elif N_dim==3:
-            Qout_hdu[0].data[:,y,x]=Pcorr.real
-            Uout_hdu[0].data[:,y,x]=Pcorr.imag
-        if x == 0:
-            progress(40, i/Npix*100)
+    #Correct one frequency plane at a time. Only that plane is read from
+    #the input files, and each corrected plane is written straight into the
+    #(memory-mapped) output file.
+    Nchan=theta_real.size
+    if theta_threshold is None:
+        good=np.ones(Nchan,dtype=bool)
+    else:
+        good=theta_real**2+theta_imag**2 >= theta_threshold**2
+    for k in range(Nchan):
+        if not good[k]:
+            write_plane(Qout_hdu,k,freq_axis,np.nan)
+            write_plane(Uout_hdu,k,freq_axis,np.nan)
+            progress(40, (k+1)/Nchan*100)
+            continue
+        Qplane=read_plane(hdulistQ,k,freq_axis)
+        Uplane=read_plane(hdulistU,k,freq_axis)
+        Qcorr,Ucorr=correct_cubes(Qplane[np.newaxis],Uplane[np.newaxis],
+                                  (theta_real[k:k+1],theta_imag[k:k+1]))
+        write_plane(Qout_hdu,k,freq_axis,Qcorr[0])
+        write_plane(Uout_hdu,k,freq_axis,Ucorr[0])
+        progress(40, (k+1)/Nchan*100)
 
     Qout_hdu.flush()
     Uout_hdu.flush()
     Qout_hdu.close()
     Uout_hdu.close()
+    hdulistQ.close()
+    hdulistU.close()
+
+
+
+
+
+def correct_cubes_dask(Qdata,Udata,theta,axis=0,theta_threshold=None):
+    """Dask version of correct_cubes(), for cubes too large for one machine's
+    memory. The data are split into one block per frequency channel, and
+    each block is corrected independently with correct_cubes(), so the
+    correction can be run on arbitrarily large cubes (and on a Dask cluster)
+    with memory use bounded by a few planes per worker. Requires dask.
+    
+    Inputs:
+        Qdata (array): uncorrected Stokes Q data (numpy or dask array)
+        Udata (array): uncorrected Stokes U data (numpy or dask array)
+        theta (1D array): ionospheric modulation, per frequency (complex, or
+            a (real part, imaginary part) tuple, as for correct_cubes)
+        axis (int): frequency axis of the data, in numpy ordering [0]
+        theta_threshold (float): minimum |theta| for a channel to be
+            corrected; other channels are set to NaN [None: correct all channels]
+    
+    Returns:
+        Qcorr (dask array): corrected Stokes Q data, same axis ordering
+        Ucorr (dask array): corrected Stokes U data, same axis ordering
+        (these are lazy: nothing is computed until they are computed or stored)
+    """
+    #dask is only needed for the dask backend, and is slow to import, so it
+    #is only imported when used.
+    try:
+        import dask.array as da
+    except ImportError:
+        raise Exception("The dask backend requires dask to be installed.")
+    if isinstance(theta,tuple):
+        theta_real,theta_imag=(np.asarray(part,dtype=np.float64) for part in theta)
+    else:
+        theta_real,theta_imag=theta.real,theta.imag
+
+    Qdata=da.asarray(Qdata)
+    Udata=da.asarray(Udata)
+    axis=axis % Qdata.ndim
+    #Check here, so that a mismatch is reported before anything is computed.
+    if Qdata.shape != Udata.shape:
+        raise Exception("Q and U data don't have same dimensions.")
+    if theta_real.size != Qdata.shape[axis]:
+        raise Exception("Modulation does not have same number of channels as data.")
+    #One block per channel, with the full extent of every other axis.
+    chunks=tuple(1 if i == axis else -1 for i in range(Qdata.ndim))
+    Qdata=Qdata.rechunk(chunks)
+    Udata=Udata.rechunk(chunks)
+    dtype=np.result_type(Qdata.dtype,Udata.dtype,np.float32)
+
+    #Q and U are corrected together, so each block returns both, stacked on
+    #a new leading axis.
+    corrected=da.map_blocks(_correct_block,Qdata,Udata,dtype=dtype,new_axis=0,
+                            chunks=((2,),)+Qdata.chunks,theta_real=theta_real,
+                            theta_imag=theta_imag,axis=axis,
+                            theta_threshold=theta_threshold)
+    return corrected[0],corrected[1]
+
+
+def _correct_block(Qblock,Ublock,theta_real,theta_imag,axis,theta_threshold,
+                   block_info=None):
+    """Corrects one block of correct_cubes_dask(), selecting the modulation
+    for the channels covered by the block. The dask workers already provide
+    the parallelism, so each block is corrected on a single thread.
+    """
+    start,stop=block_info[0]['array-location'][axis]
+    Qcorr,Ucorr=correct_cubes(Qblock,Ublock,(theta_real[start:stop],theta_imag[start:stop]),
+                              axis=axis,theta_threshold=theta_threshold,parallel=False)
+    return np.stack((Qcorr,Ucorr))
+
+
+def apply_correction_dask(Qfile,Ufile,predictionfile,Qoutfile,Uoutfile,
+                          overwrite=False,theta_threshold=None):
+    """Functions as apply_correction_to_files, but uses Dask to process the
+    cubes one frequency channel at a time, in parallel. Like
+    apply_correction_large_cube(), the cubes never need to fit in memory:
+    each channel is read from the input files (through read_plane()),
+    corrected, and written into output files created beforehand. The work is
+    done by the active Dask scheduler: by default, threads on the local
+    machine, or the workers of a dask.distributed cluster if a client has
+    been started (in which case all workers must be able to access the
+    input and output files, e.g. on a shared file system).
+    This function requires that the frequency axis can be identified from
+    the FITS header, and that dask is installed.
+    
+    Args:
+        Qfile (str): filename of uncorrected Stokes Q FITS cube
+        Ufile (str): filename of uncorrected Stokes U FITS cube
+        predictionfile (str): path to ionospheric modulation prediction (from predict tools)
+        Qoutfile (str): filename for corrected Stokes Q FITS cube.
+        Uoutfile (str): filename for corrected Stokes U FITS cube.
+        overwrite (bool): overwrite Stokes Q/U files if they already exist? [False]
+        theta_threshold (float): channels where the modulation amplitude
+            |theta| is below this are set to NaN instead of being corrected.
+            [None: correct all channels]
+    
+    """
+    try:
+        import dask
+        import dask.array as da
+    except ImportError:
+        raise Exception("The dask backend requires dask to be installed.")
 
+    #Get all data:
+    frequencies,theta_real,theta_imag=read_prediction(predictionfile,split=True)
+
+    with pf.open(Qfile) as hdulistQ, pf.open(Ufile) as hdulistU:
+        header=hdulistQ[0].header.copy()
+        shape=hdulistQ[0].shape
+        Ushape=hdulistU[0].shape
+        N_dim=header['NAXIS'] #Get number of axes
+        freq_axis=find_freq_axis(header)
+        #Checks for data consistency.
+        if freq_axis == 0:
+            raise Exception("Could not identify frequency axis; this is required for the dask backend.")
+        if shape != Ushape:
+            raise Exception("Q and U files don't have same dimensions.")
+        if shape[N_dim-freq_axis] != theta_real.size:
+            raise Exception("Prediction file does not have same number of channels as FITS cube.")
+        dtype=read_plane(hdulistQ,0,freq_axis).dtype
+
+    #Build lazy cubes from per-channel reads, so each block only reads its
+    #own plane from disk.
+    axis=N_dim-freq_axis
+    plane_shape=shape[:axis]+shape[axis+1:]
+    Qdata,Udata=(da.stack([da.from_delayed(dask.delayed(_read_plane_from_file)(filename,k,freq_axis),
+                                           shape=plane_shape,dtype=dtype)
+                           for k in range(theta_real.size)],axis=axis)
+                 for filename in (Qfile,Ufile))
+
+    Qcorr,Ucorr=correct_cubes_dask(Qdata,Udata,(theta_real,theta_imag),axis=axis,
+                                   theta_threshold=theta_threshold)
+
+    output_header=_create_output_files(header,Qoutfile,Uoutfile,overwrite)
+    da.store([Qcorr,Ucorr],[_FITSDataWriter(Qoutfile,output_header),
+                            _FITSDataWriter(Uoutfile,output_header)],lock=False)
 
 
+def _read_plane_from_file(filename,k,freq_axis):
+    """Reads a single frequency plane from a FITS file, given its name."""
+    with pf.open(filename) as hdulist:
+        return read_plane(hdulist,k,freq_axis)
+
+
+class _FITSDataWriter:
+    """Target for dask.array.store() that writes into the data of an
+    existing (uncompressed, single-HDU) FITS file. Each write maps the file
+    afresh, so this can be sent to other processes or machines, and blocks
+    written concurrently do not interfere as long as they don't overlap.
+    """
+    def __init__(self,filename,header):
+        self.filename=filename
+        self.offset=len(header.tostring())
+        self.shape=tuple(header['NAXIS'+str(i)] for i in range(header['NAXIS'],0,-1))
+        self.dtype=np.dtype('>f{0}'.format(abs(header['BITPIX'])//8))
+
+    def __setitem__(self,key,value):
+        data=np.memmap(self.filename,dtype=self.dtype,mode='r+',offset=self.offset,
+                       shape=self.shape)
+        data[key]=value
+        data.flush()
 
 
 def command_line():
@@ -347,8 +968,26 @@ def command_line():
                         help="Overwrite exising output files? [False]")
     parser.add_argument("-L",dest="large",action="store_true",
                         help="Use large-file mode? (Reduced memory footprint) [False]")    
+    parser.add_argument("-D",dest="dask",action="store_true",
+                        help="Use the Dask backend? (Reduced memory footprint, parallel) [False]")
+    parser.add_argument("-c",dest="compress",action="store_true",
+                        help="Write tile-compressed (lossy) output files? [False]")
+    parser.add_argument("-m",dest="theta_threshold",type=float,default=None,
+                        help="Minimum |theta| to correct; channels with stronger\ndepolarization are set to NaN [correct all channels]")
+    parser.add_argument("-t",dest="nthreads",type=int,default=None,
+                        help="Number of threads to use [all available cores]")
 
     args = parser.parse_args()
+    if args.compress and (args.large or args.dask):
+        parser.error("Compressed output (-c) is not supported in large-file (-L) or dask (-D) mode.")
+
+    #numexpr caps its default thread count well below the core count of large
+    #machines, so use every core unless the user has asked otherwise (with -t,
+    #or through the environment). This is only done here: importing the
+    #module leaves the thread settings to the user.
+    if (args.nthreads is not None or
+            not {'NUMEXPR_NUM_THREADS','OMP_NUM_THREADS'} & set(os.environ)):
+        set_num_threads(args.nthreads)
 
     #Check for file existence.
     if not os.path.isfile(args.fitsQ):
@@ -356,14 +995,21 @@ def command_line():
     if not os.path.isfile(args.fitsU):
         raise Exception("Stokes U file not found.")
     
-    #Pass file names into do-everything function (either basic or large-file, as
-    #set by user.
-    if args.large:
+    #Pass file names into do-everything function (either basic, large-file, or
+    #dask, as set by user.
+    if args.dask:
+        apply_correction_dask(args.fitsQ,args.fitsU,args.predictionfile,
+                              args.outQ,args.outU,overwrite=args.overwrite,
+                              theta_threshold=args.theta_threshold)
+    elif args.large:
         apply_correction_large_cube(args.fitsQ,args.fitsU,args.predictionfile,
-                              args.outQ,args.outU,overwrite=args.overwrite)        
+                              args.outQ,args.outU,overwrite=args.overwrite,
+                              theta_threshold=args.theta_threshold)
     else:
         apply_correction_to_files(args.fitsQ,args.fitsU,args.predictionfile,
-                              args.outQ,args.outU,overwrite=args.overwrite)
+                              args.outQ,args.outU,overwrite=args.overwrite,
+                              compress=args.compress,
+                              theta_threshold=args.theta_threshold)
 
 
 
@@ -19,7 +19,10 @@ REQUIRED = [
     'numpy', 'astropy', 'pyephem',
     ]
 
-extras_require={}
+extras_require={
+    'fast': ['numexpr', 'numba'],
+    'dask': ['dask[array]'],
+    }
 
 here = os.path.abspath(os.path.dirname(__file__))
 
@@ -45,6 +48,7 @@ setup(
                             'frion_correct=FRion.correct:command_line'],
     },
     install_requires=REQUIRED,
+    extras_require=extras_require,
     include_package_data=True,
     license='MIT',
     classifiers=[
@@ -0,0 +1,154 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+
+import FRion.correct
+from FRion.correct import (apply_correction_large_cube, apply_correction_to_files,
+                           correct_cubes, correct_cubes_dask)
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#Runs correct_cubes_dask() on dask's threaded scheduler with several workers,
+#in a separate process so that an abort (e.g. from numba's workqueue
+#threading layer) fails the test instead of killing the test run.
+THREADED_SCRIPT = """
+import numpy as np
+import dask
+from FRion.correct import correct_cubes_dask
+
+rng = np.random.default_rng(0)
+Q = rng.normal(size=(16, 64, 64)).astype(np.float32)
+U = rng.normal(size=(16, 64, 64)).astype(np.float32)
+theta = 0.8*np.exp(1j*np.linspace(0, 3, 16))
+with dask.config.set(scheduler='threads', num_workers=4):
+    for axis, (q, u) in enumerate([(Q, U), (np.moveaxis(Q, 0, 1), np.moveaxis(U, 0, 1))]):
+        Qcorr, Ucorr = dask.compute(*correct_cubes_dask(q, u, theta, axis=axis))
+        expected = np.moveaxis((Q + 1j*U)/theta[:, None, None], 0, axis)
+        assert np.allclose(Qcorr, expected.real, atol=1e-5)
+        assert np.allclose(Ucorr, expected.imag, atol=1e-5)
+"""
+
+
+def test_dask_threaded_scheduler():
+    pytest.importorskip("dask")
+    env = dict(os.environ, NUMBA_NUM_THREADS='4',
+               PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get('PYTHONPATH')])))
+    try:
+        import numba  # noqa: F401
+        env['NUMBA_THREADING_LAYER'] = 'workqueue'
+    except ImportError:
+        pass
+    result = subprocess.run([sys.executable, '-c', THREADED_SCRIPT], env=env,
+                            capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+
+def test_dask_channel_mismatch():
+    pytest.importorskip("dask")
+    Q = np.ones((4, 5, 5))
+    with pytest.raises(Exception, match="number of channels"):
+        correct_cubes_dask(Q, Q, np.ones(3, dtype=complex))
+
+
+def make_data(shape, axis, dtype=np.float64, seed=0):
+    """Random Q, U and theta (with a spread of amplitudes), and the
+    reference correction computed by complex division."""
+    rng = np.random.default_rng(seed)
+    Q = rng.normal(size=shape).astype(dtype)
+    U = rng.normal(size=shape).astype(dtype)
+    Nchan = shape[axis]
+    theta = np.linspace(0.05, 1, Nchan)*np.exp(1j*np.linspace(0, 3, Nchan))
+    theta_shape = [1]*len(shape)
+    theta_shape[axis] = Nchan
+    expected = (Q.astype(np.float64) + 1j*U)/theta.reshape(theta_shape)
+    return Q, U, theta, expected
+
+
+@pytest.fixture(params=['numba', 'numexpr', 'numpy'])
+def backend(request, monkeypatch):
+    """Runs a test with each backend, by disabling the faster ones."""
+    if request.param == 'numba' and FRion.correct.numba is None:
+        pytest.skip("numba not installed")
+    if request.param == 'numexpr' and FRion.correct.ne is None:
+        pytest.skip("numexpr not installed")
+    if request.param in ('numexpr', 'numpy'):
+        monkeypatch.setattr(FRion.correct, 'numba', None)
+    if request.param == 'numpy':
+        monkeypatch.setattr(FRion.correct, 'ne', None)
+    return request.param
+
+
+@pytest.mark.parametrize('shape,axis', [((6, 10, 12), 0), ((10, 6, 12), 1),
+                                        ((10, 12, 6), 2), ((2, 6, 10, 12), 1)])
+@pytest.mark.parametrize('dtype', [np.float32, np.float64, '>f4'])
+@pytest.mark.parametrize('inplace', [False, True])
+def test_correct_cubes(backend, shape, axis, dtype, inplace):
+    Q, U, theta, expected = make_data(shape, axis, dtype)
+    if inplace:
+        Qcorr, Ucorr = correct_cubes(Q, U, theta, out_Q=Q, out_U=U, axis=axis)
+        assert Qcorr is Q and Ucorr is U
+    else:
+        Qcorr, Ucorr = correct_cubes(Q, U, theta, axis=axis)
+        assert Qcorr.dtype == np.result_type(np.dtype(dtype), np.float32)
+    tol = 1e-4 if np.dtype(dtype).itemsize == 4 else 1e-10
+    assert np.allclose(Qcorr, expected.real, rtol=tol, atol=tol)
+    assert np.allclose(Ucorr, expected.imag, rtol=tol, atol=tol)
+
+
+@pytest.mark.parametrize('out', ['out_Q=U', 'out_U=Q', 'swapped'])
+def test_correct_cubes_aliased_outputs(backend, out):
+    Q, U, theta, expected = make_data((6, 10, 12), 0)
+    kwargs = {'out_Q=U': dict(out_Q=U), 'out_U=Q': dict(out_U=Q),
+              'swapped': dict(out_Q=U, out_U=Q)}[out]
+    Qcorr, Ucorr = correct_cubes(Q, U, theta, **kwargs)
+    assert np.allclose(Qcorr, expected.real)
+    assert np.allclose(Ucorr, expected.imag)
+
+
+@pytest.mark.parametrize('inplace', [False, True])
+def test_correct_cubes_threshold(backend, inplace):
+    Q, U, theta, expected = make_data((10, 8, 6), 2)
+    theta[3] = 0
+    good = np.abs(theta) >= 0.3
+    out = dict(out_Q=Q, out_U=U) if inplace else {}
+    with np.errstate(all='raise'):
+        Qcorr, Ucorr = correct_cubes(Q, U, theta, axis=2, theta_threshold=0.3, **out)
+    assert np.isnan(Qcorr[..., ~good]).all() and np.isnan(Ucorr[..., ~good]).all()
+    assert np.allclose(Qcorr[..., good], expected.real[..., good])
+    assert np.allclose(Ucorr[..., good], expected.imag[..., good])
+
+
+def test_correct_cubes_channel_mismatch():
+    Q = np.ones((4, 6, 5))
+    with pytest.raises(Exception, match="number of channels"):
+        correct_cubes(Q, Q, np.ones(3, dtype=complex))
+
+
+def test_large_cube_matches_in_memory(tmp_path):
+    Q, U, theta, expected = make_data((2, 6, 10, 12), 1, np.float32)
+    header = fits.Header()
+    header['CTYPE3'] = 'FREQ'
+    header['CRVAL3'] = 1e9
+    header['CDELT3'] = 1e6
+    header['CRPIX3'] = 1
+    for name, data in (('Q', Q), ('U', U)):
+        fits.writeto(tmp_path/(name + '.fits'), data, header)
+    frequencies = 1e9 + 1e6*np.arange(theta.size)
+    np.savetxt(tmp_path/'prediction.txt', np.column_stack((frequencies, theta.real, theta.imag)))
+
+    args = [str(tmp_path/name) for name in ('Q.fits', 'U.fits', 'prediction.txt')]
+    apply_correction_to_files(*args, str(tmp_path/'Qmem.fits'), str(tmp_path/'Umem.fits'))
+    apply_correction_large_cube(*args, str(tmp_path/'Qlarge.fits'), str(tmp_path/'Ularge.fits'))
+
+    for name, reference in (('Q', expected.real), ('U', expected.imag)):
+        in_memory = fits.getdata(tmp_path/(name + 'mem.fits'))
+        large = fits.getdata(tmp_path/(name + 'large.fits'))
+        assert in_memory.shape == large.shape == reference.shape
+        assert np.array_equal(in_memory, large)
+        assert np.allclose(in_memory, reference, rtol=1e-4, atol=1e-4)